@@ -7,21 +7,29 @@ This script:
 3. Trains a transformer encoder model on the book text
 4. Tests the model to see if it can predict next words
 5. Includes detailed comments for understanding
+
+Requires PyTorch 2.3 or newer (torch.compile, torch.amp.GradScaler).
 """
 
-import pandas as pd
 import numpy as np
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 import torch.optim as optim
-from torch.utils.data import Dataset, DataLoader
-from sklearn.model_selection import train_test_split
-from sklearn.metrics import accuracy_score
+from torch.utils.data import TensorDataset, DataLoader
 import re
 from collections import Counter
 import time
 import urllib.request
 import os
+import multiprocessing
+import json
+try:
+    from safetensors.torch import save_model
+    SAFETENSORS_AVAILABLE = True
+except ImportError:
+    SAFETENSORS_AVAILABLE = False
+    # We'll save a regular PyTorch checkpoint (.pth) instead
 
 # Set random seeds for reproducibility
 torch.manual_seed(42)
@@ -103,6 +111,11 @@ Preprocessing involves:
 
 print("\n[STEP 2] Preprocessing text...")
 
+# Regular expressions used by preprocess_text, compiled once at startup
+# (generate_text calls preprocess_text again for every seed)
+NON_WORD_PATTERN = re.compile(r'[^\w\s]')   # Special characters
+WHITESPACE_PATTERN = re.compile(r'\s+')      # Runs of spaces/newlines
+
 def preprocess_text(text):
     """
     Clean and normalize the text.
@@ -117,10 +130,10 @@ def preprocess_text(text):
     
     # Remove special characters but keep spaces and basic punctuation
     # This keeps the text readable while simplifying it
-    text = re.sub(r'[^\w\s]', ' ', text)
+    text = NON_WORD_PATTERN.sub(' ', text)
     
     # Replace multiple spaces with single space
-    text = re.sub(r'\s+', ' ', text)
+    text = WHITESPACE_PATTERN.sub(' ', text)
     
     # Remove leading/trailing whitespace
     text = text.strip()
@@ -195,26 +208,24 @@ def create_sequences(tokens, seq_length=50):
         inputs: List of input sequences
         targets: List of target sequences (shifted by 1 position)
     """
+    # Convert words to indices (numbers) ONCE for the whole text
+    # Every word shows up in up to 2*seq_length windows, so converting inside
+    # the loop would repeat the same dictionary lookups ~100 times per word
+    get_idx = word_to_idx.get
+    unk_idx = word_to_idx['<UNK>']
+    token_indices = [get_idx(word, unk_idx) for word in tokens]
+
     inputs = []
     targets = []
-    
+
     # Slide a window of size seq_length through the text
-    for i in range(len(tokens) - seq_length):
+    for i in range(len(token_indices) - seq_length):
         # Input: words from position i to i+seq_length-1
-        input_seq = tokens[i:i+seq_length]
-        
+        inputs.append(token_indices[i:i+seq_length])
+
         # Target: words from position i+1 to i+seq_length (shifted by 1)
-        target_seq = tokens[i+1:i+seq_length+1]
-        
-        # Convert words to indices (numbers)
-        input_indices = [word_to_idx.get(word, word_to_idx['<UNK>']) 
-                        for word in input_seq]
-        target_indices = [word_to_idx.get(word, word_to_idx['<UNK>']) 
-                         for word in target_seq]
-        
-        inputs.append(input_indices)
-        targets.append(target_indices)
-    
+        targets.append(token_indices[i+1:i+seq_length+1])
+
     return inputs, targets
 
 seq_length = 50  # Context window: model sees 50 words to predict the next
@@ -255,43 +266,58 @@ print(f"Test sequences: {len(X_test):,}")
 # ============================================================================
 """
 PyTorch uses Dataset and DataLoader to efficiently load data during training.
-- Dataset: Defines how to get one sample
+- Dataset: Defines how to get one sample (here: a TensorDataset)
 - DataLoader: Batches samples together for efficient training
 """
 
-class BookDataset(Dataset):
-    """
-    Custom dataset class for book text sequences.
-    
-    This tells PyTorch how to get one training example.
-    """
-    def __init__(self, inputs, targets):
-        self.inputs = inputs
-        self.targets = targets
-    
-    def __len__(self):
-        """Return total number of sequences"""
-        return len(self.inputs)
-    
-    def __getitem__(self, idx):
-        """
-        Get one training example.
-        
-        Returns:
-            input_seq: Sequence of word indices (input to model)
-            target_seq: Sequence of word indices (what model should predict)
-        """
-        return torch.tensor(self.inputs[idx], dtype=torch.long), \
-               torch.tensor(self.targets[idx], dtype=torch.long)
-
-# Create datasets
-train_dataset = BookDataset(X_train, y_train)
-test_dataset = BookDataset(X_test, y_test)
+# Convert the sequences to tensors ONCE, up front
+# torch.from_numpy shares memory with the numpy arrays (no copy), and
+# TensorDataset just slices these tensors to get one training example,
+# so no new tensors are built per sample while training
+# Each example is (input_seq, target_seq): sequences of word indices
+train_dataset = TensorDataset(torch.from_numpy(X_train).long(),
+                              torch.from_numpy(y_train).long())
+test_dataset = TensorDataset(torch.from_numpy(X_test).long(),
+                             torch.from_numpy(y_test).long())
 
 # Create data loaders (batches data for efficient training)
-batch_size = 32  # Process 32 sequences at once
-train_loader = DataLoader(train_dataset, batch_size=batch_size, shuffle=True)
-test_loader = DataLoader(test_dataset, batch_size=batch_size, shuffle=False)
+# pin_memory puts each batch in page-locked memory, so the copy to the GPU
+# can run in the background (non_blocking=True in the loops below)
+# On GPU, 32 sequences of 50 words leave most of the GPU idle, and each
+# step's time goes to launching kernels rather than computing. Larger
+# batches keep it busy and need 4x fewer steps per epoch.
+batch_size = 128 if torch.cuda.is_available() else 32  # Sequences processed at once
+loader_options = {'pin_memory': torch.cuda.is_available()}
+
+# Worker processes build the next batches while the GPU is busy training.
+# They are kept alive between epochs (persistent_workers) instead of being
+# restarted every epoch.
+# - Only when training on GPU: on CPU the workers would compete with the
+#   model for the same cores
+# - Only with the 'fork' start method (Linux): with 'spawn' (the default
+#   on Windows/macOS) every worker would re-run this whole script
+if torch.cuda.is_available() and 'fork' in multiprocessing.get_all_start_methods():
+    loader_options.update(
+        num_workers=min(4, os.cpu_count() or 1),
+        persistent_workers=True,
+        prefetch_factor=4,
+        multiprocessing_context='fork',
+    )
+
+# drop_last (GPU only): skip the final, smaller training batch so every
+# step has the same [batch_size, seq_length] shape. The compiled model (see
+# STEP 7) can then replay one captured CUDA Graph for every step instead of
+# compiling and capturing a second one for the odd-sized batch. The dropped
+# sequences differ each epoch because of the shuffle.
+# (Kept off when there isn't even one full batch, which would leave none.)
+train_options = dict(loader_options)
+if torch.cuda.is_available() and len(train_dataset) >= batch_size:
+    train_options['drop_last'] = True
+
+train_loader = DataLoader(train_dataset, batch_size=batch_size, shuffle=True,
+                          **train_options)
+test_loader = DataLoader(test_dataset, batch_size=batch_size, shuffle=False,
+                         **loader_options)
 
 print(f"Batch size: {batch_size}")
 print(f"Training batches: {len(train_loader)}")
@@ -313,7 +339,8 @@ Transformer Encoder Architecture:
    - Word at position 0 gets different encoding than word at position 10
 
 3. Transformer Encoder Layers:
-   - Multi-head Self-Attention: Each word "looks at" all other words
+   - Multi-head Self-Attention: Each word "looks at" itself and the words
+     before it (causal attention: it can't peek at the word it must predict)
    - Feed-Forward Network: Processes each word independently
    - Layer Normalization: Stabilizes training
    - Residual Connections: Helps gradients flow
@@ -321,8 +348,106 @@ Transformer Encoder Architecture:
 4. Output Layer:
    - Predicts the next word for each position
    - Output size = vocabulary size (probability for each word)
+
+The attention step uses PyTorch's F.scaled_dot_product_attention, which picks
+a fused kernel (FlashAttention / memory-efficient attention) when available.
+These compute softmax(Q·K^T / sqrt(d_k))·V in one pass without ever storing
+the full [batch, heads, seq, seq] attention matrix in memory.
+
+Because attention is causal, the keys/values of earlier words never change
+when a new word is added. generate_text() caches them (a "KV cache"), so each
+generated word only runs the model on that one new word.
 """
 
+class EncoderLayer(nn.Module):
+    """
+    One Transformer Encoder layer (self-attention + feed-forward).
+
+    Same structure as PyTorch's nn.TransformerEncoderLayer (post-norm, ReLU),
+    but attention runs through F.scaled_dot_product_attention.
+    """
+
+    def __init__(self, d_model, nhead, dim_feedforward, dropout):
+        super(EncoderLayer, self).__init__()
+
+        self.nhead = nhead
+        self.head_dim = d_model // nhead  # Each head works on d_model/nhead dims
+        self.attn_dropout = dropout
+
+        # Self-attention: one Linear produces Q, K and V together (one matmul
+        # instead of three), then out_proj merges the heads back together
+        self.qkv_proj = nn.Linear(d_model, 3 * d_model)
+        self.out_proj = nn.Linear(d_model, d_model)
+
+        # Feed-forward network: d_model -> dim_feedforward -> d_model
+        self.linear1 = nn.Linear(d_model, dim_feedforward)
+        self.linear2 = nn.Linear(dim_feedforward, d_model)
+
+        # Layer normalization and dropout (regularization)
+        self.norm1 = nn.LayerNorm(d_model)
+        self.norm2 = nn.LayerNorm(d_model)
+        self.dropout = nn.Dropout(dropout)
+        self.dropout1 = nn.Dropout(dropout)
+        self.dropout2 = nn.Dropout(dropout)
+
+        # Initialize attention weights the same way nn.MultiheadAttention does
+        nn.init.xavier_uniform_(self.qkv_proj.weight)
+        nn.init.zeros_(self.qkv_proj.bias)
+        nn.init.zeros_(self.out_proj.bias)
+
+    def forward(self, x, kv_cache=None, attn_mask=None):
+        """
+        Args:
+            x: [batch_size, seq_length, d_model]
+            kv_cache: Optional dict with this layer's keys/values for earlier
+                      positions (used by generate_text, see
+                      TransformerLanguageModel.init_kv_caches). The
+                      keys/values of x are written after them. Either empty
+                      (x is the whole prompt) or x is a single new position.
+            attn_mask: Optional boolean mask, True where attention is allowed
+                       (used by generate_text to hide padding). Replaces the
+                       default causal mask, so it must include causality.
+
+        Returns:
+            [batch_size, seq_length, d_model]
+        """
+        batch_size, seq_length, d_model = x.size()
+
+        # Project to Q, K, V and split into heads:
+        # [batch, seq, 3*d_model] -> 3 x [batch, nhead, seq, head_dim]
+        qkv = self.qkv_proj(x).view(batch_size, seq_length, 3, self.nhead, self.head_dim)
+        q, k, v = qkv.permute(2, 0, 3, 1, 4)
+
+        # Write the new keys/values into the cache (in place, no new
+        # tensors), then attend over everything cached so far
+        if kv_cache is not None:
+            start = kv_cache['length']
+            end = start + seq_length
+            kv_cache['k'][:, :, start:end] = k
+            kv_cache['v'][:, :, start:end] = v
+            kv_cache['length'] = end
+            k = kv_cache['k'][:, :, :end]
+            v = kv_cache['v'][:, :, :end]
+
+        # Fused causal attention: softmax(Q·K^T / sqrt(head_dim))·V, where each
+        # position only attends to itself and earlier positions.
+        # A single new position may attend to everything in the cache.
+        attn = F.scaled_dot_product_attention(
+            q, k, v,
+            attn_mask=attn_mask,
+            dropout_p=self.attn_dropout if self.training else 0.0,
+            is_causal=attn_mask is None and seq_length > 1
+        )
+
+        # Merge heads back: [batch, nhead, seq, head_dim] -> [batch, seq, d_model]
+        attn = attn.transpose(1, 2).reshape(batch_size, seq_length, d_model)
+
+        # Residual connection + layer norm around attention...
+        x = self.norm1(x + self.dropout1(self.out_proj(attn)))
+        # ...and around the feed-forward network
+        x = self.norm2(x + self.dropout2(self.linear2(self.dropout(F.relu(self.linear1(x))))))
+        return x
+
 class TransformerLanguageModel(nn.Module):
     """
     Transformer Encoder for Language Modeling (Next Word Prediction)
@@ -342,6 +467,13 @@ class TransformerLanguageModel(nn.Module):
         # d_model = size of each word vector (embedding dimension)
         self.embedding = nn.Embedding(vocab_size, d_model)
         
+        # The same matrix is reused by the output layer (see 4. below), so it
+        # starts small (std 1/sqrt(d_model)) to keep the initial predictions
+        # calm. forward() scales the embeddings back up by sqrt(d_model) so
+        # they aren't drowned out by the positional encoding.
+        nn.init.normal_(self.embedding.weight, std=d_model ** -0.5)
+        self.embed_scale = d_model ** 0.5
+        
         # 2. POSITIONAL ENCODING: Add position information
         # Learnable positional embeddings (alternative to fixed sinusoidal)
         self.pos_encoder = nn.Embedding(max_seq_length, d_model)
@@ -351,55 +483,86 @@ class TransformerLanguageModel(nn.Module):
         #   - Multi-head self-attention (nhead = number of attention heads)
         #   - Feed-forward network (dim_feedforward = hidden size)
         #   - Layer normalization and dropout
-        encoder_layer = nn.TransformerEncoderLayer(
-            d_model=d_model,              # Embedding dimension
-            nhead=nhead,                   # Number of attention heads
-            dim_feedforward=dim_feedforward,  # Feed-forward network size
-            dropout=dropout,               # Dropout rate (regularization)
-            batch_first=True               # Batch dimension first
-        )
-        self.transformer_encoder = nn.TransformerEncoder(
-            encoder_layer, 
-            num_layers=num_layers  # Stack multiple encoder layers
-        )
+        # Stack multiple encoder layers (num_layers = depth)
+        self.encoder_layers = nn.ModuleList([
+            EncoderLayer(
+                d_model=d_model,                  # Embedding dimension
+                nhead=nhead,                      # Number of attention heads
+                dim_feedforward=dim_feedforward,  # Feed-forward network size
+                dropout=dropout                   # Dropout rate (regularization)
+            )
+            for _ in range(num_layers)
+        ])
         
         # 4. OUTPUT LAYER: Predict next word
         # Input: d_model (embedding size)
         # Output: vocab_size (probability for each word in vocabulary)
+        # Weight tying: the output layer shares its weight matrix with the
+        # embedding layer (a word's input vector is also used to score it as
+        # the next word). Halves the largest group of parameters and usually
+        # improves language models. The bias stays separate.
         self.output_layer = nn.Linear(d_model, vocab_size)
+        self.output_layer.weight = self.embedding.weight
         
         self.dropout = nn.Dropout(dropout)
         
-    def forward(self, x):
+    def init_kv_caches(self, batch_size):
+        """
+        Create an empty KV cache for each encoder layer.
+        
+        The key/value buffers are allocated once for the longest possible
+        sequence; EncoderLayer fills them in place as words are added.
+        Setting 'length' back to 0 empties a cache for reuse.
+        """
+        max_seq_length = self.pos_encoder.num_embeddings
+        weight = self.pos_encoder.weight
+        kv_caches = []
+        for layer in self.encoder_layers:
+            shape = (batch_size, layer.nhead, max_seq_length, layer.head_dim)
+            kv_caches.append({
+                'k': torch.zeros(shape, dtype=weight.dtype, device=weight.device),
+                'v': torch.zeros(shape, dtype=weight.dtype, device=weight.device),
+                'length': 0,
+            })
+        return kv_caches
+    
+    def forward(self, x, kv_caches=None, positions=None, attn_mask=None):
         """
         Forward pass through the model.
         
         Args:
             x: Input sequences [batch_size, seq_length]
                Each number is a word index
+            kv_caches: Optional list with one KV cache dict per encoder layer
+                       (from init_kv_caches)
+            positions: Optional position of each word [batch_size, seq_length]
+                       (default: 0, 1, 2, ...)
+            attn_mask: Optional attention mask (see EncoderLayer.forward)
         
         Returns:
             logits: [batch_size, seq_length, vocab_size]
                     Probability scores for each word at each position
         """
-        batch_size, seq_length = x.size()
+        seq_length = x.size(1)
         
         # Step 1: Convert word indices to embeddings
         # x: [batch, seq] -> embeddings: [batch, seq, d_model]
-        x = self.embedding(x) * np.sqrt(self.d_model)
+        x = self.embedding(x) * self.embed_scale
         
         # Step 2: Add positional encoding
-        # Create position indices: [0, 1, 2, ..., seq_length-1]
-        positions = torch.arange(0, seq_length, device=x.device).unsqueeze(0)
-        positions = positions.expand(batch_size, -1)
-        
-        # Add positional embeddings
-        x = x + self.pos_encoder(positions)
+        # In training the positions are always [0, 1, 2, ..., seq_length-1],
+        # so instead of looking them up we take the first seq_length rows of
+        # the position embedding table: [seq, d_model], broadcast over the batch
+        if positions is None:
+            x = x + self.pos_encoder.weight[:seq_length]
+        else:
+            x = x + self.pos_encoder(positions)
         x = self.dropout(x)
         
         # Step 3: Pass through transformer encoder
-        # The encoder applies self-attention and feed-forward layers
-        x = self.transformer_encoder(x)
+        # Each layer applies self-attention and feed-forward layers
+        for i, layer in enumerate(self.encoder_layers):
+            x = layer(x, None if kv_caches is None else kv_caches[i], attn_mask)
         
         # Step 4: Predict next word for each position
         # [batch, seq, d_model] -> [batch, seq, vocab_size]
@@ -415,6 +578,33 @@ print("\n[STEP 5] Initializing transformer model...")
 device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
 print(f"Using device: {device}")
 
+# TF32: on Ampere and newer GPUs, let float32 matrix multiplications (the
+# attention and feed-forward Linear layers) run on Tensor Cores with a
+# slightly shorter mantissa. TF32 only affects matmuls (and convolutions),
+# not elementwise math like the optimizer's weight updates. Training runs
+# under mixed precision below, so this mainly speeds up the float32 matmuls
+# outside autocast, e.g. in generate_text().
+if device.type == 'cuda':
+    torch.set_float32_matmul_precision('high')
+
+# Mixed precision (AMP): on GPU, run the forward pass in 16-bit floats
+# Half the bytes per tensor = twice the memory bandwidth, and the matrix
+# multiplications can use Tensor Cores. Weights stay in 32-bit.
+# - bfloat16 (Ampere and newer GPUs) has the same range as float32, so it
+#   needs no loss scaling
+# - float16 (older GPUs such as Turing/Volta, which only emulate bfloat16
+#   slowly) can underflow small gradients to zero, so the loss is scaled up
+#   by a GradScaler before backward()
+# - On CPU everything stays in float32
+use_amp = device.type == 'cuda'
+if use_amp and torch.cuda.get_device_capability(device)[0] >= 8:
+    amp_dtype = torch.bfloat16
+else:
+    amp_dtype = torch.float16
+scaler = torch.amp.GradScaler(device.type, enabled=use_amp and amp_dtype == torch.float16)
+if use_amp:
+    print(f"Mixed precision training: {amp_dtype}")
+
 model = TransformerLanguageModel(
     vocab_size=vocab_size,
     d_model=128,           # Word embedding dimension (size of each word vector)
@@ -433,6 +623,30 @@ print(f"  - Embedding dimension: 128")
 print(f"  - Attention heads: 4")
 print(f"  - Encoder layers: 2")
 
+# Compile the model for the training and evaluation loops
+# torch.compile traces the forward pass once and generates fused GPU kernels
+# for it, which every later step reuses. mode="reduce-overhead" also replays
+# each step as a CUDA Graph, cutting the per-kernel launch overhead that
+# dominates a model this small.
+# - Only on GPU: on CPU the compile time outweighs the gain for this short run
+# - `model` stays the plain (eager) module: generate_text() feeds it inputs
+#   of varying length, and saving uses its state_dict
+compiled_model = model
+if device.type == 'cuda':
+    try:
+        print("Compiling model with torch.compile...")
+        compiled_model = torch.compile(model, mode="reduce-overhead")
+        # Warm up with one dummy forward + backward pass so the one-time
+        # compilation cost isn't counted in the training time
+        dummy_batch = torch.zeros(batch_size, seq_length, dtype=torch.long, device=device)
+        with torch.autocast(device_type=device.type, dtype=amp_dtype, enabled=use_amp):
+            dummy_loss = compiled_model(dummy_batch).float().sum()
+        dummy_loss.backward()
+        model.zero_grad(set_to_none=True)
+    except Exception as e:
+        print(f"torch.compile failed ({e}), using the uncompiled model")
+        compiled_model = model
+
 # ============================================================================
 # STEP 8: SETUP TRAINING
 # ============================================================================
@@ -447,11 +661,17 @@ print("\n[STEP 6] Setting up training...")
 
 # Loss function: Cross-entropy for classification
 # Compares predicted word probabilities with actual next word
-criterion = nn.CrossEntropyLoss()
+# F.cross_entropy takes the raw scores (logits) and does log-softmax + loss
+# in one fused call, without building a separate probability tensor
+criterion = F.cross_entropy
 
 # Optimizer: Adam (adaptive learning rate)
 # Updates model weights to minimize loss
-optimizer = optim.Adam(model.parameters(), lr=0.001)
+# The learning rate (0.001 for batches of 32) grows with the square root
+# of the batch size: bigger batches give less noisy gradients, so the model
+# can take bigger steps
+learning_rate = 0.001 * (batch_size / 32) ** 0.5
+optimizer = optim.Adam(model.parameters(), lr=learning_rate)
 
 # Learning rate scheduler: Reduces learning rate every 5 epochs
 # Helps model converge better
@@ -482,46 +702,53 @@ model.train()  # Set model to training mode (enables dropout, etc.)
 start_time = time.time()
 
 for epoch in range(num_epochs):
-    total_loss = 0
-    total_correct = 0
+    # Loss and correct-word counts are summed on the device and only read
+    # back once per epoch: every .item() makes the CPU wait for the GPU
+    total_loss = torch.zeros((), device=device)
+    total_correct = torch.zeros((), dtype=torch.long, device=device)
     total_tokens = 0
     
     # Process each batch of sequences
     for batch_idx, (inputs, targets) in enumerate(train_loader):
-        inputs = inputs.to(device)  # Move to GPU if available
-        targets = targets.to(device)
+        inputs = inputs.to(device, non_blocking=True)  # Move to GPU if available
+        targets = targets.to(device, non_blocking=True)
         
-        # FORWARD PASS: Model predicts next words
+        # FORWARD PASS: Model predicts next words (in mixed precision on GPU)
         # inputs: [batch, seq_length] - input sequences
         # outputs: [batch, seq_length, vocab_size] - predicted word probabilities
-        outputs = model(inputs)
-        
-        # Reshape for loss calculation
-        # We need: [batch*seq, vocab_size] and [batch*seq]
-        outputs_flat = outputs.view(-1, vocab_size)
-        targets_flat = targets.view(-1)
-        
-        # Calculate loss: How different are predictions from actual words?
-        loss = criterion(outputs_flat, targets_flat)
+        with torch.autocast(device_type=device.type, dtype=amp_dtype, enabled=use_amp):
+            outputs = compiled_model(inputs)
+            
+            # Reshape for loss calculation
+            # We need: [batch*seq, vocab_size] and [batch*seq]
+            outputs_flat = outputs.view(-1, vocab_size)
+            targets_flat = targets.view(-1)
+            
+            # Calculate loss: How different are predictions from actual words?
+            # (autocast computes cross-entropy in float32 for accuracy)
+            loss = criterion(outputs_flat, targets_flat)
         
         # BACKWARD PASS: Calculate gradients
-        optimizer.zero_grad()  # Clear previous gradients
-        loss.backward()        # Calculate gradients
-        optimizer.step()       # Update model weights
+        # The scaler is a no-op unless training in float16
+        optimizer.zero_grad(set_to_none=True)  # Clear previous gradients
+        scaler.scale(loss).backward()          # Calculate gradients
+        scaler.step(optimizer)                 # Update model weights
+        scaler.update()
         
         # Calculate accuracy: How many words predicted correctly?
-        _, predicted = torch.max(outputs_flat, 1)
-        total_correct += (predicted == targets_flat).sum().item()
-        total_tokens += targets_flat.size(0)
-        
-        total_loss += loss.item()
+        with torch.no_grad():
+            _, predicted = torch.max(outputs_flat, 1)
+            total_correct += (predicted == targets_flat).sum()
+            total_tokens += targets_flat.size(0)
+            
+            total_loss += loss.detach()
     
     # Update learning rate
     scheduler.step()
     
     # Calculate average metrics for this epoch
-    avg_loss = total_loss / len(train_loader)
-    accuracy = 100 * total_correct / total_tokens
+    avg_loss = total_loss.item() / len(train_loader)
+    accuracy = 100 * total_correct.item() / total_tokens
     
     print(f"Epoch [{epoch+1}/{num_epochs}] - "
           f"Loss: {avg_loss:.4f} - "
@@ -546,32 +773,33 @@ print("\n[STEP 8] Testing model on unseen data...")
 print("="*80)
 
 model.eval()  # Set to evaluation mode (disables dropout, etc.)
-test_loss = 0
-test_correct = 0
+test_loss = torch.zeros((), device=device)
+test_correct = torch.zeros((), dtype=torch.long, device=device)
 test_tokens = 0
 
 with torch.no_grad():  # Don't calculate gradients (faster, saves memory)
     for inputs, targets in test_loader:
-        inputs = inputs.to(device)
-        targets = targets.to(device)
+        inputs = inputs.to(device, non_blocking=True)
+        targets = targets.to(device, non_blocking=True)
         
         # Forward pass
-        outputs = model(inputs)
-        outputs_flat = outputs.view(-1, vocab_size)
-        targets_flat = targets.view(-1)
-        
-        # Calculate loss
-        loss = criterion(outputs_flat, targets_flat)
-        test_loss += loss.item()
+        with torch.autocast(device_type=device.type, dtype=amp_dtype, enabled=use_amp):
+            outputs = compiled_model(inputs)
+            outputs_flat = outputs.view(-1, vocab_size)
+            targets_flat = targets.view(-1)
+            
+            # Calculate loss
+            loss = criterion(outputs_flat, targets_flat)
+        test_loss += loss
         
         # Calculate accuracy
         _, predicted = torch.max(outputs_flat, 1)
-        test_correct += (predicted == targets_flat).sum().item()
+        test_correct += (predicted == targets_flat).sum()
         test_tokens += targets_flat.size(0)
 
 # Calculate metrics
-avg_test_loss = test_loss / len(test_loader)
-test_accuracy = 100 * test_correct / test_tokens
+avg_test_loss = test_loss.item() / len(test_loader)
+test_accuracy = 100 * test_correct.item() / test_tokens
 
 # Perplexity: Measure of how "surprised" the model is by the test data
 # Lower perplexity = better model
@@ -593,69 +821,109 @@ We'll give it a starting sequence and see what words it predicts.
 print("\n[STEP 9] Testing model - Generating text predictions...")
 print("="*80)
 
-def generate_text(model, seed_text, max_length=20, temperature=1.0):
+def generate_text(model, seed_texts, max_length=20, temperature=1.0):
     """
     Generate text by predicting next words one at a time.
     
+    All seeds are generated together as one batch, so each step is a single
+    forward pass for every seed.
+    
     Args:
         model: Trained transformer model
-        seed_text: Starting text (e.g., "alice was")
+        seed_texts: List of starting texts (e.g., ["alice was", "the rabbit"]),
+                    or a single starting text
         max_length: How many words to generate
         temperature: Controls randomness (higher = more random)
     
     Returns:
-        Generated text
+        List of generated texts (one per seed), or a single generated text
+        if seed_texts was a single text
     """
     model.eval()
     
-    # Tokenize seed text
-    seed_tokens = tokenize(preprocess_text(seed_text))
+    single_seed = isinstance(seed_texts, str)
+    if single_seed:
+        seed_texts = [seed_texts]
+    
+    pad_idx = word_to_idx['<PAD>']
+    special_idx = torch.tensor([word_to_idx[word] for word in ['<PAD>', '<UNK>', '<START>', '<END>']],
+                               device=device)
+    cache_positions = torch.arange(seq_length, device=device)
+    
+    # Tokenize seed texts
+    seed_tokens = [tokenize(preprocess_text(seed_text)) for seed_text in seed_texts]
     
     # Convert to indices
-    current_seq = [word_to_idx.get(word, word_to_idx['<UNK>']) 
-                   for word in seed_tokens[-seq_length:]]  # Take last seq_length words
+    # (word_to_idx.get and the <UNK> index are looked up once, not per word)
+    get_idx = word_to_idx.get
+    unk_idx = word_to_idx['<UNK>']
+    sequences = [[get_idx(word, unk_idx) for word in tokens[-seq_length:]]  # Take last seq_length words
+                 for tokens in seed_tokens]
     
-    generated = seed_tokens.copy()
+    generated = [tokens.copy() for tokens in seed_tokens]
+    
+    def run_prompt():
+        """Run the model on every sequence, refilling the KV cache."""
+        # Left-pad shorter sequences so every row's last word is at the same
+        # cache slot, and number each row's words from 0 after its padding
+        # (at least one slot, so seeds with no words still get a <PAD> to start from)
+        prompt_length = max(1, max(len(seq) for seq in sequences))
+        pad_lengths = torch.tensor([prompt_length - len(seq) for seq in sequences], device=device)
+        input_tensor = torch.tensor([[pad_idx] * (prompt_length - len(seq)) + seq
+                                     for seq in sequences], dtype=torch.long, device=device)
+        positions = (cache_positions[:prompt_length] - pad_lengths[:, None]).clamp(min=0)
+        
+        # Causal mask that also hides the padding
+        # (padding slots still see themselves, so no row is fully masked)
+        is_word = cache_positions[:prompt_length] >= pad_lengths[:, None]
+        causal = torch.ones(prompt_length, prompt_length, dtype=torch.bool, device=device).tril()
+        diagonal = torch.eye(prompt_length, dtype=torch.bool, device=device)
+        attn_mask = causal & (is_word[:, None, :] | diagonal)
+        
+        for kv_cache in kv_caches:
+            kv_cache['length'] = 0
+        output = model(input_tensor, kv_caches, positions, attn_mask[:, None])
+        return output[:, -1, :], pad_lengths  # Prediction for the last word
     
     with torch.no_grad():
-        for _ in range(max_length):
-            # Prepare input
-            if len(current_seq) < seq_length:
-                # Pad if needed
-                padded = current_seq + [word_to_idx['<PAD>']] * (seq_length - len(current_seq))
-            else:
-                padded = current_seq[-seq_length:]
-            
-            input_tensor = torch.tensor([padded], dtype=torch.long).to(device)
-            
-            # Get prediction
-            output = model(input_tensor)
-            
-            # Get prediction for last position
-            last_output = output[0, -1, :]  # [vocab_size]
-            
+        # Allocate the KV cache once for the whole generation
+        kv_caches = model.init_kv_caches(batch_size=len(sequences))
+        
+        # Run the seed texts once; later steps only feed the newest words
+        last_output, pad_lengths = run_prompt()
+        
+        for step in range(max_length):
             # Apply temperature (controls randomness)
             last_output = last_output / temperature
             
-            # Convert to probabilities
-            probs = torch.softmax(last_output, dim=0)
+            # Avoid padding and special tokens
+            last_output[:, special_idx] = float('-inf')
             
-            # Sample next word (with some randomness)
-            next_idx = torch.multinomial(probs, 1).item()
-            next_word = idx_to_word[next_idx]
+            # Convert to probabilities and sample the next word of every row
+            probs = torch.softmax(last_output, dim=-1)
+            next_tokens = torch.multinomial(probs, 1)  # [batch, 1], stays on the device
             
-            # Avoid padding and special tokens
-            if next_word in ['<PAD>', '<UNK>', '<START>', '<END>']:
-                continue
+            for seq, words, next_idx in zip(sequences, generated, next_tokens.view(-1).tolist()):
+                seq.append(next_idx)
+                words.append(idx_to_word[next_idx])
             
-            generated.append(next_word)
-            current_seq.append(next_idx)
+            if step == max_length - 1:
+                break
             
-            # Keep sequence length manageable
-            if len(current_seq) > seq_length:
-                current_seq = current_seq[-seq_length:]
+            cache_length = kv_caches[0]['length']
+            if cache_length < seq_length:
+                # Feed only the new words; earlier words come from the cache
+                positions = cache_length - pad_lengths[:, None]
+                attn_mask = cache_positions[:cache_length + 1] >= pad_lengths[:, None]
+                output = model(next_tokens, kv_caches, positions, attn_mask[:, None, None, :])
+                last_output = output[:, -1, :]
+            else:
+                # Out of positions: slide the windows and rebuild the cache
+                sequences = [seq[-seq_length:] for seq in sequences]
+                last_output, pad_lengths = run_prompt()
     
-    return ' '.join(generated)
+    generated_texts = [' '.join(words) for words in generated]
+    return generated_texts[0] if single_seed else generated_texts
 
 # Test with different seed texts
 test_seeds = [
@@ -666,8 +934,8 @@ test_seeds = [
 
 print("\nGenerated Text Examples:")
 print("-" * 80)
-for seed in test_seeds:
-    generated = generate_text(model, seed, max_length=15, temperature=0.8)
+generated_texts = generate_text(model, test_seeds, max_length=15, temperature=0.8)
+for seed, generated in zip(test_seeds, generated_texts):
     print(f"\nSeed: '{seed}'")
     print(f"Generated: {generated}")
     print()
@@ -685,22 +953,43 @@ Save the trained model and vocabulary so we can load it later for testing.
 """
 print("\n[STEP 10] Saving model and vocabulary...")
 
-# Save model state
-torch.save({
-    'model_state_dict': model.state_dict(),
+# Model settings needed to rebuild the model before loading the weights
+model_config = {
     'vocab_size': vocab_size,
     'd_model': 128,
     'nhead': 4,
     'num_layers': 2,
     'dim_feedforward': 256,
     'max_seq_length': seq_length,
-    'word_to_idx': word_to_idx,
-    'idx_to_word': idx_to_word,
     'seq_length': seq_length,
-}, 'transformer_model.pth')
-
-print("Model saved to: transformer_model.pth")
-print("Vocabulary saved with model")
+}
+
+if SAFETENSORS_AVAILABLE:
+    # Weights go to a safetensors file: no pickle, and loading can
+    # memory-map it straight into the model
+    # (reload with: safetensors.torch.load_model(model, 'transformer_model.safetensors'))
+    # save_model (rather than save_file) handles the embedding/output layer
+    # weight that is shared between two layers
+    save_model(model, 'transformer_model.safetensors')
+    
+    # Settings and vocabulary go to plain JSON
+    # The vocabulary list is in index order: word_to_idx = {word: i for i, word in enumerate(vocab)}
+    with open('transformer_model.json', 'w', encoding='utf-8') as f:
+        json.dump({**model_config, 'vocab': vocab}, f)
+    
+    print("Model saved to: transformer_model.safetensors")
+    print("Vocabulary saved to: transformer_model.json")
+else:
+    # Save model state
+    torch.save({
+        'model_state_dict': model.state_dict(),
+        **model_config,
+        'word_to_idx': word_to_idx,
+        'idx_to_word': idx_to_word,
+    }, 'transformer_model.pth')
+    
+    print("Model saved to: transformer_model.pth")
+    print("Vocabulary saved with model")
 
 print("="*80)
 print(f"""
@@ -719,7 +1008,7 @@ WHAT THE MODEL LEARNED:
 The transformer encoder model learned to predict the next word in a sequence
 by understanding patterns in the book text. It uses:
 
-- Self-Attention: Each word "looks at" all other words in the sequence
+- Self-Attention: Each word "looks at" the words before it in the sequence
   to understand context and relationships
 
 - Positional Encoding: Understands word order (first word vs last word)